@@ -1,6 +1,12 @@
 import streamlit as st
 import pandas as pd
+import json
+import random
+import sqlite3
+import time
+from contextlib import closing
 from datetime import datetime
+from pathlib import Path
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -11,6 +17,23 @@ SCOPE = [
     "https://www.googleapis.com/auth/spreadsheets"
 ]
 SPREADSHEET_NAME = "CMTask-ManagerDB"
+FLUSH_DELAY = 2.0  # seconds without edits before queued writes are sent
+FLUSH_MAX_OPS = 20  # queued writes that trigger a flush without waiting
+RETRY_ATTEMPTS = 5
+RETRY_STATUSES = (429, 500, 503)  # rate limit and transient server errors
+# A 5xx on a write may still have been applied, so batches that append or delete
+# rows only retry when the request was rejected outright
+WRITE_RETRY_STATUSES = (429,)
+PAGE_SIZE = 50  # tasks shown per page of the task list
+LOCAL_CACHE = Path.home() / ".cache" / "cmtask" / "tasks.db"
+# A task is closed when its category is CT, so there is no separate closed column
+HEADERS = ["description", "building", "tcd", "comments", "category", "last_updated"]
+LAST_COLUMN = chr(ord("A") + len(HEADERS) - 1)
+COLUMN_INDEX = {h: i for i, h in enumerate(HEADERS)}
+TASK_DEFAULTS = {
+    "description": "", "building": "", "tcd": "", "comments": "",
+    "category": "OT", "last_updated": ""
+}
 
 # Define categories and colors
 CATEGORIES = {
@@ -25,100 +48,458 @@ BUILDINGS = [
     "NHQ", "NEC", "SCU", "RO"
 ]
 
-# --- GOOGLE SHEETS MANAGER ---
-class GoogleSheetsManager:
-    def __init__(self):
-        self.tasks = self.load_tasks()
+# Selectbox options and positions, used on every rerun
+CATEGORY_KEYS = tuple(CATEGORIES)
+CATEGORY_INDEX = {c: i for i, c in enumerate(CATEGORY_KEYS)}
+NON_ALL_CATEGORIES = tuple(c for c in CATEGORIES if c != "All")
+NON_ALL_INDEX = {c: i for i, c in enumerate(NON_ALL_CATEGORIES)}
+BUILDING_INDEX = {b: i for i, b in enumerate(BUILDINGS)}
+
+# Per-category markup, formatted once instead of per task on every rerun
+CATEGORY_CELL_STYLE = {c: f"background-color: {color}" for c, color in CATEGORIES.items()}
+STAT_LINE = {c: f"<div style='color:{CATEGORIES[c]};font-weight:600'>{c}: {{}}</div>" for c in NON_ALL_CATEGORIES}
+
+# Custom CSS styling
+CSS = """
+<style>
+html, body, [class*="css"] {
+    font-family: "Segoe UI", Roboto, "Helvetica Neue", sans-serif;
+    color: #2F3E46;
+}
+.stApp {
+    background-color: #F8FAFB;
+}
+h1, h2, h3 {
+    color: #1C3D5A;
+    font-weight: 600;
+}
+.stButton button {
+    border-radius: 8px;
+    font-weight: 500;
+    padding: 0.5em 1em;
+}
+</style>
+"""
+
+# --- GOOGLE SHEETS CONNECTION ---
+@st.cache_resource(show_spinner=False)
+def get_client():
+    # Secrets are parsed and authorized once per process, not per sheet call
+    if 'google_credentials' not in st.secrets:
+        raise RuntimeError("Google credentials not found in Streamlit Secrets.")
+    creds = Credentials.from_service_account_info(dict(st.secrets['google_credentials']), scopes=SCOPE)
+    return gspread.authorize(creds)
 
-    def get_credentials(self):
+@st.cache_resource(show_spinner=False)
+def get_worksheet():
+    # Reused across reruns and sessions to skip the spreadsheet lookup.
+    # An optional 'spreadsheet_id' secret opens by key and avoids the Drive title search.
+    gc = get_client()
+    spreadsheet_id = st.secrets.get('spreadsheet_id')
+    sh = gc.open_by_key(spreadsheet_id) if spreadsheet_id else gc.open(SPREADSHEET_NAME)
+    return sh.sheet1
+
+def with_worksheet(action, retry_statuses=RETRY_STATUSES):
+    for attempt in range(RETRY_ATTEMPTS):
         try:
-            if 'google_credentials' in st.secrets:
-                creds_dict = dict(st.secrets['google_credentials'])
-                creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
-                return gspread.authorize(creds)
-            else:
-                st.error("Google credentials not found in Streamlit Secrets.")
-                return None
-        except Exception as e:
-            st.error(f"Error loading credentials: {e}")
-            return None
+            return action(get_worksheet())
+        except gspread.exceptions.APIError as e:
+            code = e.response.status_code
+            if code == 401 and attempt == 0:
+                # Stale authorization: drop the cached handles and retry right away
+                get_client.clear()
+                get_worksheet.clear()
+                continue
+            if code not in retry_statuses or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            # Quota and transient server errors back off exponentially with jitter
+            time.sleep(2 ** attempt + random.random())
+
+# --- LOCAL SHEET CACHE ---
+# A snapshot of the sheet on disk, reused while Drive reports the same modifiedTime.
+# The cache is best effort: a local failure, or no modifiedTime from Drive, just falls
+# back to reading the sheet.
+def read_local_rows(key, modified):
+    try:
+        with closing(sqlite3.connect(LOCAL_CACHE)) as conn:
+            found = conn.execute(
+                "SELECT rows FROM sheet_cache WHERE key = ? AND modified = ?", (key, modified)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+    except (sqlite3.Error, OSError, ValueError):
+        return None
+
+def write_local_rows(key, modified, rows):
+    try:
+        LOCAL_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(LOCAL_CACHE)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sheet_cache (key TEXT PRIMARY KEY, modified TEXT, rows TEXT)")
+            conn.execute("INSERT OR REPLACE INTO sheet_cache VALUES (?, ?, ?)", (key, modified, json.dumps(rows)))
+    except (sqlite3.Error, OSError):
+        pass
+
+def drop_local_rows():
+    try:
+        with closing(sqlite3.connect(LOCAL_CACHE)) as conn, conn:
+            conn.execute("DELETE FROM sheet_cache")
+    except (sqlite3.Error, OSError):
+        pass
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_tasks():
+    # Raw sheet rows (header first), shared by every rerun and session until the TTL
+    # expires or a write clears the cache
+    def read(ws):
+        sh = ws.spreadsheet
+        try:
+            modified = sh.get_lastUpdateTime()
+        except gspread.exceptions.APIError:
+            # modifiedTime comes from the Drive API, which may be down or not enabled
+            # for the project; read the sheet directly and leave the snapshot alone
+            return ws.get_all_values()
+        rows = read_local_rows(sh.id, modified)
+        if rows is None:
+            # Full width on purpose: cells right of the app's columns still decide
+            # where appendCells puts the next row
+            rows = ws.get_all_values()
+            write_local_rows(sh.id, modified, rows)
+        return rows
+
+    return with_worksheet(read)
+
+def invalidate_tasks():
+    # Drive's modifiedTime can lag a write, so our own writes drop the disk snapshot too
+    fetch_tasks.clear()
+    drop_local_rows()
+
+# --- GOOGLE SHEETS MANAGER ---
+class GoogleSheetsManager:
+    # Stateless sheet client; the task list itself lives in session state
 
     def load_tasks(self):
+        # Returns (tasks, other_rows, layout_ok), or None when the sheet could not be read.
+        # other_rows are the sheet rows holding data that isn't a task; layout_ok says the
+        # header starts with HEADERS in order, which positional writes rely on.
         try:
-            gc = self.get_credentials()
-            if not gc:
-                return []
-            sh = gc.open(SPREADSHEET_NAME)
-            ws = sh.sheet1
-            records = ws.get_all_records()
-            formatted_records = [
-                {
-                    "description": rec.get("description", ""),
-                    "building": rec.get("building", ""),
-                    "tcd": rec.get("tcd", ""),
-                    "comments": rec.get("comments", ""),
-                    "category": rec.get("category", "OT"),
-                    "last_updated": rec.get("last_updated", ""),
-                    "closed": rec.get("closed", False)
-                }
-                for rec in records if any(rec.values())
-            ]
-            return formatted_records
+            rows = fetch_tasks()
+            if not rows:
+                return [], [], True
+            # Index rows by their sheet row number so writes still land right when
+            # blank rows are skipped; columns are matched by header name
+            frame = pd.DataFrame(rows[1:], columns=rows[0], index=range(2, len(rows) + 1))
+            frame = frame.loc[:, ~frame.columns.duplicated()].reindex(columns=HEADERS).fillna(TASK_DEFAULTS)
+            # Rows with nothing in the app's columns are not tasks, but they still
+            # decide where appendCells lands, so they are kept in other_rows
+            frame = frame.loc[(frame != "").any(axis=1)]
+            # Unknown or blank categories become OT here, so display code can index by category
+            frame.loc[~frame["category"].isin(NON_ALL_CATEGORIES), "category"] = TASK_DEFAULTS["category"]
+            frame["_row"] = frame.index
+            task_rows = set(frame.index)
+            other_rows = [i for i, r in enumerate(rows, start=1) if any(r) and i not in task_rows]
+            return frame.to_dict("records"), other_rows, rows[0][:len(HEADERS)] == HEADERS
         except gspread.SpreadsheetNotFound:
             st.error(f"Spreadsheet '{SPREADSHEET_NAME}' not found.")
-            return []
+            return None
         except Exception as e:
             st.error(f"Error loading tasks: {e}")
-            return []
+            return None
 
-    def save_tasks(self, tasks):
-        try:
-            gc = self.get_credentials()
-            if not gc:
-                return False
-            sh = gc.open(SPREADSHEET_NAME)
-            ws = sh.sheet1
-            ws.clear()
-            if tasks:
-                headers = ["description", "building", "tcd", "comments", "category", "last_updated", "closed"]
-                ws.append_row(headers)
-                for t in tasks:
-                    ws.append_row([
-                        t.get("description", ""),
-                        t.get("building", ""),
-                        t.get("tcd", ""),
-                        t.get("comments", ""),
-                        t.get("category", "OT"),
-                        t.get("last_updated", ""),
-                        t.get("closed", False)
-                    ])
-            return True
-        except Exception as e:
-            st.error(f"Error saving tasks: {e}")
-            return False
+    def task_row(self, task):
+        return [task.get(h, TASK_DEFAULTS[h]) for h in HEADERS]
 
-    def add_or_update_task(self, task_data, idx=None):
-        try:
-            if idx is not None:
-                self.tasks[idx] = task_data
+    def rebuild(self):
+        # Rewrites the sheet from its live contents: the app's columns first in HEADERS
+        # order, any other columns after them, rows blank everywhere dropped. Values are
+        # copied as they are, so categories are not normalized. Errors propagate.
+        def write(ws):
+            shown = ws.get_all_values()
+            header = shown[0] if shown else []
+            source = {}
+            for i, h in enumerate(header):
+                source.setdefault(h, i)
+            own = [source.get(h) for h in HEADERS]
+            extra = [i for i in range(len(header)) if i not in own]
+            # Other columns are read unrendered so their formulas and numbers survive
+            raw = ws.get_all_values(value_render_option="FORMULA") if extra else []
+            height = max(len(shown), len(raw))
+            keep = [r for r in range(height) if r == 0 or any(self.cell(shown, r, i) for i in range(len(header)))
+                    or any(self.cell(raw, r, i) != "" for i in extra)]
+            rows = [
+                self.cells([self.cell(shown, r, i) if i is not None else "" for i in own])["values"]
+                + [self.typed_cell(self.cell(raw, r, i)) for i in extra]
+                for r in keep[1:]
+            ]
+            rows.insert(0, self.cells(HEADERS + [header[i] for i in extra])["values"])
+            # One batchUpdate writes the new grid and clears what lies below it, so a
+            # failure leaves the sheet as it was
+            requests = [{"updateCells": {"start": {"sheetId": ws.id, "rowIndex": 0, "columnIndex": 0},
+                                         "rows": [{"values": r} for r in rows], "fields": "userEnteredValue"}}]
+            if height > len(rows):
+                requests.append({"updateCells": {"range": {"sheetId": ws.id, "startRowIndex": len(rows),
+                                                           "endRowIndex": height, "startColumnIndex": 0,
+                                                           "endColumnIndex": len(HEADERS) + len(extra)},
+                                                 "fields": "userEnteredValue"}})
+            ws.spreadsheet.batch_update({"requests": requests})
+
+        with_worksheet(write)
+        invalidate_tasks()
+
+    def cell(self, grid, r, i):
+        return grid[r][i] if r < len(grid) and i < len(grid[r]) else ""
+
+    def typed_cell(self, value):
+        if isinstance(value, bool):
+            return {"userEnteredValue": {"boolValue": value}}
+        if isinstance(value, (int, float)):
+            return {"userEnteredValue": {"numberValue": value}}
+        if isinstance(value, str) and value.startswith("="):
+            return {"userEnteredValue": {"formulaValue": value}}
+        return {"userEnteredValue": {"stringValue": str(value)}}
+
+    def cells(self, values):
+        return {"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in values]}
+
+    def op_requests(self, sheet_id, op):
+        # Ops carry 1-based sheet row numbers; the API wants 0-based indices
+        kind, row, data, _ = op
+        if kind == "header":
+            return [{"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                                     "rows": [self.cells(HEADERS)], "fields": "userEnteredValue"}}]
+        if kind == "append":
+            return [{"appendCells": {"sheetId": sheet_id, "rows": [self.cells(self.task_row(data))],
+                                     "fields": "userEnteredValue"}}]
+        if kind == "update":
+            # Only the changed fields are sent, one cell each
+            return [
+                {"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": row - 1, "columnIndex": COLUMN_INDEX[h]},
+                                 "rows": [self.cells([v])], "fields": "userEnteredValue"}}
+                for h, v in data.items()
+            ]
+        return [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                               "startIndex": row - 1, "endIndex": row}}}]
+
+    def row_values(self, values):
+        # A raw sheet row as load_tasks would present it, to compare with a queued snapshot
+        values = (list(values) + [""] * len(HEADERS))[:len(HEADERS)]
+        if values[COLUMN_INDEX["category"]] not in NON_ALL_CATEGORIES:
+            values[COLUMN_INDEX["category"]] = TASK_DEFAULTS["category"]
+        return values
+
+    def check_ops(self, ws, ops):
+        # Row numbers come from this session's snapshot. Work out which original row
+        # each op lands on, then read back only those rows (plus the last row with data
+        # before an append) and refuse the batch if another session moved or changed them.
+        changed = RuntimeError("the sheet was changed elsewhere since it was loaded")
+        # ids[i] is the original row now at row i + 1: None if this batch added it,
+        # 0 if it lies below this batch's appends and must be blank
+        ids, tail = [], 1
+        empty, expected, boundaries, deleted = False, {}, [], set()
+
+        def at(row):
+            nonlocal tail
+            while len(ids) < row:
+                ids.append(tail)
+                tail = tail and tail + 1
+            return ids[row - 1]
+
+        for kind, row, data, before in ops:
+            if kind == "header":
+                if ids or tail != 1:
+                    raise changed
+                empty, ids, tail = True, [None], 0
+            elif kind == "append":
+                # appendCells goes below the last row with data, which must be row - 1
+                above = at(row - 1) if row > 1 else 0
+                if above == 0 or None in ids[row - 1:]:
+                    raise changed
+                if above:
+                    boundaries.append(above)
+                ids[row - 1:], tail = [None], 0
             else:
-                self.tasks.append(task_data)
-            return self.save_tasks(self.tasks)
-        except Exception as e:
-            st.error(f"Error updating task: {e}")
-            return False
+                original = at(row) if row > 1 else 0
+                if original == 0:
+                    raise changed
+                if original and original not in expected:
+                    expected[original] = before
+                if kind == "delete":
+                    deleted.add(original)
+                    del ids[row - 1]
 
-    def delete_task(self, idx):
-        try:
-            if 0 <= idx < len(self.tasks):
-                del self.tasks[idx]
-                return self.save_tasks(self.tasks)
+        width = gspread.utils.rowcol_to_a1(1, max(len(HEADERS), ws.col_count)).rstrip("1")
+        ranges = ([f"A1:{width}"] if empty else []) + [f"A{o}:{LAST_COLUMN}{o}" for o in expected] \
+            + [f"A{o}:{width}" for o in boundaries]
+        if not ranges:
+            return
+        got = iter(ws.batch_get(ranges))
+        ok = not (empty and any(any(r) for r in next(got)))
+        for before in expected.values():
+            values = next(got)
+            ok = ok and self.row_values(values[0] if values else []) == before
+        for o in boundaries:
+            values = next(got)
+            ok = ok and bool(values) and any(values[0]) \
+                and not any(any(r) for k, r in enumerate(values[1:], o + 1) if k not in deleted)
+        if not ok:
+            raise changed
+
+    def apply_ops(self, ops):
+        # Queued changes go out in order as a single spreadsheets.batchUpdate.
+        # Errors propagate so flush_pending can report which changes were dropped.
+        def write(ws):
+            # One small read per flush buys the check; a change landing between this
+            # read and the batch is still possible, but the window is a single round-trip
+            self.check_ops(ws, ops)
+            requests = [r for op in ops for r in self.op_requests(ws.id, op)]
+            ws.spreadsheet.batch_update({"requests": requests})
+
+        with_worksheet(write, WRITE_RETRY_STATUSES)
+        invalidate_tasks()
+
+sheets = GoogleSheetsManager()
+
+# --- HELPER FUNCTIONS ---
+def set_tasks(loaded):
+    # Takes load_tasks()'s result. Changes are refused after a failed read, and while the
+    # sheet's columns are out of order, since writes address cells by position.
+    tasks, other_rows, layout_ok = loaded or ([], None, False)
+    st.session_state.tasks = tasks
+    st.session_state.other_rows = other_rows
+    if loaded is None:
+        st.session_state.read_only = "Tasks could not be loaded from the sheet. Refresh before making changes."
+    elif not layout_ok:
+        st.session_state.read_only = "The sheet's columns are not in the expected order. Use Rebuild Sheet before making changes."
+    else:
+        st.session_state.read_only = None
+    st.session_state.task_views = {}
+    # A selection is a position in the old list, so it can't carry over to the new one
+    clear_form()
+
+def tasks_frame():
+    # DataFrame view of the session's tasks, rebuilt only after they change
+    views = st.session_state.task_views
+    if "frame" not in views:
+        views["frame"] = pd.DataFrame(st.session_state.tasks, columns=HEADERS)
+    return views["frame"]
+
+def category_view(category):
+    # Filtered frame per category, built on first use after each task change
+    views = st.session_state.task_views
+    key = ("view", category)
+    if key not in views:
+        frame = tasks_frame()
+        views[key] = frame if category == "All" else frame[frame["category"] == category]
+    return views[key]
+
+def category_counts():
+    views = st.session_state.task_views
+    if "counts" not in views:
+        views["counts"] = tasks_frame()["category"].value_counts().to_dict()
+    return views["counts"]
+
+def queue_op(op):
+    # Writes are applied locally now and sent once edits go quiet for FLUSH_DELAY,
+    # or straight away once enough have piled up to fill a batch. Ops live only in
+    # session state, so anything still queued is lost if the tab closes in that window.
+    st.session_state.pending_ops.append(op)
+    st.session_state.flush_after = time.monotonic() + FLUSH_DELAY
+    if len(st.session_state.pending_ops) >= FLUSH_MAX_OPS:
+        # False means the batch failed and the task list was reloaded from the sheet
+        return flush_pending()
+    return True
+
+def flush_pending():
+    ops = st.session_state.pending_ops
+    if not ops:
+        return True
+    st.session_state.pending_ops = []
+    try:
+        sheets.apply_ops(ops)
+        return True
+    except Exception as e:
+        # Kept in session state so the message outlives the rerun that follows a flush
+        dropped = "; ".join(describe_op(op) for op in ops if op[0] != "header")
+        st.session_state.save_error = f"Error saving changes: {e}. Not saved: {dropped}. The task list was reloaded from the sheet."
+    # Nothing in a failed batch was applied, so resync with the sheet
+    invalidate_tasks()
+    set_tasks(sheets.load_tasks())
+    return False
+
+def next_row():
+    # appendCells writes just below the last row holding data in any column; tasks
+    # are kept in sheet order, so the last one has the highest row
+    tasks = st.session_state.tasks
+    return max([tasks[-1]["_row"] if tasks else 0] + st.session_state.other_rows) + 1
+
+def describe_op(op):
+    kind, _, data, before = op
+    if kind == "append":
+        return f"add '{data['description']}'"
+    return f"{kind} '{before[0]}'"
+
+def writable():
+    if st.session_state.read_only:
+        st.session_state.save_error = st.session_state.read_only
+        return False
+    return True
+
+def add_or_update_task(task_data, idx=None):
+    tasks = st.session_state.tasks
+    if not writable():
+        return False
+    if idx is not None:
+        if not 0 <= idx < len(tasks):
             return False
-        except Exception as e:
-            st.error(f"Error deleting task: {e}")
+        old = tasks[idx]
+        changed = {h: task_data[h] for h in HEADERS if task_data[h] != old[h]}
+        if changed.keys() <= {"last_updated"}:
+            # Saving an unchanged task is a no-op; don't spend a write on the timestamp alone
+            return True
+        task_data["_row"] = old["_row"]
+        if not queue_op(("update", task_data["_row"], changed, sheets.task_row(old))):
+            return False
+        tasks[idx] = task_data
+    else:
+        row = next_row()
+        # An empty sheet has no header row yet
+        if row == 1:
+            if not queue_op(("header", 1, None, None)):
+                return False
+            st.session_state.other_rows = [1]
+            row = 2
+        task_data["_row"] = row
+        if not queue_op(("append", row, task_data, None)):
             return False
+        tasks.append(task_data)
+    st.session_state.task_views = {}
+    return True
+
+def delete_task(idx):
+    tasks = st.session_state.tasks
+    if not writable() or not 0 <= idx < len(tasks):
+        return False
+    row = tasks[idx]["_row"]
+    if not queue_op(("delete", row, None, sheets.task_row(tasks[idx]))):
+        return False
+    del tasks[idx]
+    # Rows below the deleted one move up in the sheet
+    for t in tasks[idx:]:
+        t["_row"] -= 1
+    st.session_state.other_rows = [r - 1 if r > row else r for r in st.session_state.other_rows]
+    st.session_state.task_views = {}
+    return True
+
+@st.fragment(run_every=1)
+def autosave():
+    if not st.session_state.pending_ops:
+        return
+    if time.monotonic() < st.session_state.flush_after:
+        st.caption(f"⏳ Saving {len(st.session_state.pending_ops)} change(s)...")
+        return
+    # A failure leaves save_error behind, which main shows once the page reruns
+    flush_pending()
+    # A full rerun refreshes the page and stops this timer until the next edit
+    st.rerun()
 
-# --- HELPER FUNCTIONS ---
 def clear_form():
     st.session_state.form_description = ''
     st.session_state.form_building = BUILDINGS[0]
@@ -127,36 +508,103 @@ def clear_form():
     st.session_state.form_category = 'OT'
     st.session_state.edit_mode = False
     st.session_state.selected_task = None
+    # A fresh table key drops any row selection left in the task list
+    st.session_state.table_version = st.session_state.get('table_version', 0) + 1
+
+def select_task():
+    # The table sits in a fragment, so ask for a full rerun to redraw the form either way
+    st.session_state.form_stale = True
+    # Selected positions refer to the filtered view rendered on the last run
+    rows = st.session_state[st.session_state.table_key].selection.rows
+    if not rows:
+        clear_form()
+        return
+    idx = st.session_state.table_rows[rows[0]]
+    t = st.session_state.tasks[idx]
+    st.session_state.edit_mode = True
+    st.session_state.selected_task = idx
+    st.session_state.form_description = t["description"]
+    st.session_state.form_building = t["building"]
+    st.session_state.form_tcd = t["tcd"]
+    st.session_state.form_comments = t["comments"]
+    st.session_state.form_category = t["category"]
+
+def delete_selected():
+    idx = st.session_state.selected_task
+    if idx is not None and delete_task(idx):
+        st.toast("Task deleted!")
+    # On failure the list was reloaded and save_error is shown by main
+    clear_form()
+
+def rebuild_sheet():
+    # Works from the live sheet rather than the session copy, which may be minutes old
+    # and missing other users' tasks. Failures are left in save_error.
+    if not flush_pending():
+        return
+    try:
+        sheets.rebuild()
+        st.toast("Sheet rebuilt!")
+    except Exception as e:
+        st.session_state.save_error = f"Sheet not rebuilt: {e}"
+
+def report_save_failure():
+    # The task list was reloaded, so the selected position may point at another task
+    clear_form()
+    st.error(st.session_state.pop('save_error', "Changes could not be saved."))
+
+@st.fragment
+def task_list():
+    # Paging reruns only this fragment; a new selection needs the whole page for the form
+    if st.session_state.form_stale:
+        st.rerun()
+
+    st.header("📋 Current Task List")
+    # The frame index is each task's position in the task list, so edits target the right row
+    view = category_view(st.session_state.current_category)
+    if view.empty:
+        st.info("No tasks found.")
+        return
+
+    # Styling is the costly part of rendering the table, so only one page is styled per run
+    pages = -(-len(view) // PAGE_SIZE)
+    page = st.number_input("Page", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+    view = view.iloc[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+
+    # One table widget for the page; selecting a row loads it into the form.
+    # The key changes with the filter and page so a selection never outlives its rows.
+    st.session_state.table_rows = list(view.index)
+    st.session_state.table_key = f"task_table_{st.session_state.table_version}_{st.session_state.current_category}_{page}"
+    st.dataframe(
+        view.style.map(CATEGORY_CELL_STYLE.__getitem__, subset=["category"]),
+        key=st.session_state.table_key,
+        on_select=select_task,
+        selection_mode="single-row",
+        hide_index=True,
+        use_container_width=True,
+        column_order=["description", "building", "tcd", "comments", "category", "last_updated"],
+        column_config={
+            "description": "Description",
+            "building": "Building",
+            "tcd": "TCD",
+            "comments": "Comments",
+            "category": "Category",
+            "last_updated": "Last Updated"
+        }
+    )
 
 # --- MAIN APP ---
 def main():
     st.set_page_config(page_title="Beldiev Original Board Operators", layout="wide")
 
-    # Custom CSS styling
-    st.markdown("""
-        <style>
-        html, body, [class*="css"] {
-            font-family: "Segoe UI", Roboto, "Helvetica Neue", sans-serif;
-            color: #2F3E46;
-        }
-        .stApp {
-            background-color: #F8FAFB;
-        }
-        h1, h2, h3 {
-            color: #1C3D5A;
-            font-weight: 600;
-        }
-        .stButton button {
-            border-radius: 8px;
-            font-weight: 500;
-            padding: 0.5em 1em;
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    # Streamlit drops elements a rerun doesn't emit, so the CSS is sent every run
+    st.markdown(CSS, unsafe_allow_html=True)
 
     # Initialize session
-    if 'task_manager' not in st.session_state:
-        st.session_state.task_manager = GoogleSheetsManager()
+    if 'pending_ops' not in st.session_state:
+        st.session_state.pending_ops = []
+    if 'tasks' not in st.session_state:
+        # Served from the shared fetch_tasks cache when another session loaded it recently
+        set_tasks(sheets.load_tasks())
     if 'selected_task' not in st.session_state:
         st.session_state.selected_task = None
     if 'edit_mode' not in st.session_state:
@@ -165,146 +613,120 @@ def main():
         clear_form()
     if 'current_category' not in st.session_state:
         st.session_state.current_category = "All"
-
-    tm = st.session_state.task_manager
+    # This run redraws the form, so a selection made since needs no extra rerun
+    st.session_state.form_stale = False
 
     st.title("🧠 Beldiev Original Board Operators")
     st.caption("Efficient, synchronized task management for operations teams")
+    if st.session_state.read_only:
+        st.warning(st.session_state.read_only)
+    # Set by a failed flush, which is usually followed by a rerun
+    if 'save_error' in st.session_state:
+        st.error(st.session_state.pop('save_error'))
 
     # Sidebar
     with st.sidebar:
         st.subheader("📂 Filter by Category")
         st.session_state.current_category = st.selectbox(
             "Category View",
-            options=list(CATEGORIES.keys()),
-            index=list(CATEGORIES.keys()).index(st.session_state.current_category)
+            options=CATEGORY_KEYS,
+            index=CATEGORY_INDEX[st.session_state.current_category]
         )
 
         st.divider()
         st.subheader("📊 Statistics")
-        cat_counts = {k: 0 for k in CATEGORIES if k != "All"}
-        for t in tm.tasks:
-            if t["category"] in cat_counts:
-                cat_counts[t["category"]] += 1
-        for cat, cnt in cat_counts.items():
-            color = CATEGORIES[cat]
-            st.markdown(f"<span style='color:{color};font-weight:600'>{cat}: {cnt}</span>", unsafe_allow_html=True)
-        st.markdown(f"**Total Tasks: {len(tm.tasks)}**")
+        cat_counts = category_counts()
+        # Emit all stat lines as one markdown element
+        stats = [STAT_LINE[cat].format(cat_counts.get(cat, 0)) for cat in NON_ALL_CATEGORIES]
+        stats.append(f"<div style='font-weight:700;margin-top:0.5em'>Total Tasks: {len(st.session_state.tasks)}</div>")
+        st.markdown("".join(stats), unsafe_allow_html=True)
+
+        if st.session_state.pending_ops:
+            autosave()
 
         if st.button("🔄 Refresh Data"):
-            st.session_state.task_manager.tasks = tm.load_tasks()
+            flush_pending()
+            invalidate_tasks()
+            # The rerun reloads tasks through the session init, reusing the cached client
+            clear_form()
+            del st.session_state.tasks
             st.success("Data refreshed!")
             st.rerun()
 
+        # Rebuilding rewrites the shared sheet, so it takes a second click to confirm
+        if st.button("🛠️ Rebuild Sheet"):
+            st.session_state.confirm_rebuild = True
+        if st.session_state.get('confirm_rebuild'):
+            st.warning("Rebuild rewrites the whole sheet: blank rows are removed and the app's columns "
+                       "are moved to the front. Other columns and all values are kept.")
+            if st.button("✅ Confirm Rebuild"):
+                st.session_state.confirm_rebuild = False
+                rebuild_sheet()
+                # Row numbers change, so the rerun reloads the task list
+                clear_form()
+                del st.session_state.tasks
+                st.rerun()
+            if st.button("✖️ Cancel Rebuild"):
+                st.session_state.confirm_rebuild = False
+                st.rerun()
+
     # --- TASK FORM ---
     st.header("📝 Task Entry / Edit Form")
-    col1, col2 = st.columns(2)
+    # Inputs only reach the script when the form is submitted, not on every edit
+    with st.form("task_form"):
+        col1, col2 = st.columns(2)
 
-    with col1:
-        description = st.text_input("Task Description*", st.session_state.form_description)
-        building = st.selectbox("Building", BUILDINGS, index=BUILDINGS.index(st.session_state.form_building))
-        tcd = st.text_input("TCD", st.session_state.form_tcd)
+        with col1:
+            description = st.text_input("Task Description*", st.session_state.form_description)
+            building = st.selectbox("Building", BUILDINGS, index=BUILDING_INDEX.get(st.session_state.form_building, 0))
+            tcd = st.text_input("TCD", st.session_state.form_tcd)
 
-    with col2:
-        comments = st.text_input("Comments", st.session_state.form_comments)
-        category = st.selectbox("Category", [c for c in CATEGORIES if c != "All"],
-                                index=list(CATEGORIES.keys()).index(st.session_state.form_category))
+        with col2:
+            comments = st.text_input("Comments", st.session_state.form_comments)
+            category = st.selectbox("Category", NON_ALL_CATEGORIES,
+                                    index=NON_ALL_INDEX.get(st.session_state.form_category, NON_ALL_INDEX["OT"]))
 
-    # Buttons: Add, Update, Delete
-    colA, colB, colC, colD = st.columns(4)
-    with colA:
-        if st.session_state.edit_mode:
-            if st.button("💾 Update Task", use_container_width=True):
-                if not description.strip():
-                    st.error("Description required.")
-                else:
-                    task = {
-                        "description": description.strip(),
-                        "building": building,
-                        "tcd": tcd,
-                        "comments": comments,
-                        "category": category,
-                        "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "closed": category == "CT"
-                    }
+        label = "💾 Update Task" if st.session_state.edit_mode else "➕ Add Task"
+        if st.form_submit_button(label, use_container_width=True):
+            if not description.strip():
+                st.error("Description required.")
+            else:
+                task = {
+                    "description": description.strip(),
+                    "building": building,
+                    "tcd": tcd,
+                    "comments": comments,
+                    "category": category,
+                    "last_updated": datetime.now().isoformat(sep=" ", timespec="seconds")
+                }
+                if st.session_state.edit_mode:
                     idx = st.session_state.selected_task
-                    if idx is not None and tm.add_or_update_task(task, idx):
+                    if idx is not None and add_or_update_task(task, idx):
                         st.success("Task updated successfully!")
                         clear_form()
                         st.rerun()
-        else:
-            if st.button("➕ Add Task", use_container_width=True):
-                if not description.strip():
-                    st.error("Description required.")
+                    else:
+                        report_save_failure()
+                elif add_or_update_task(task):
+                    st.success("Task added successfully!")
+                    clear_form()
+                    st.rerun()
                 else:
-                    task = {
-                        "description": description.strip(),
-                        "building": building,
-                        "tcd": tcd,
-                        "comments": comments,
-                        "category": category,
-                        "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "closed": category == "CT"
-                    }
-                    if tm.add_or_update_task(task):
-                        st.success("Task added successfully!")
-                        clear_form()
-                        st.rerun()
+                    report_save_failure()
+
+    # Buttons: Delete, Cancel, Clear. Their callbacks run before the rerun they trigger.
+    colA, colB, colC = st.columns(3)
+    with colA:
+        if st.session_state.edit_mode:
+            st.button("🗑️ Delete Task", key="delete_task", on_click=delete_selected, use_container_width=True)
     with colB:
         if st.session_state.edit_mode:
-            if st.button("🗑️ Delete Task", use_container_width=True):
-                idx = st.session_state.selected_task
-                if idx is not None and tm.delete_task(idx):
-                    st.success("Task deleted!")
-                    clear_form()
-                    st.rerun()
+            st.button("❌ Cancel Edit", key="cancel_edit", on_click=clear_form, use_container_width=True)
     with colC:
-        if st.session_state.edit_mode:
-            if st.button("❌ Cancel Edit", use_container_width=True):
-                clear_form()
-                st.rerun()
-    with colD:
-        if st.button("🧹 Clear Form", use_container_width=True):
-            clear_form()
-            st.rerun()
+        st.button("🧹 Clear Form", key="clear_form", on_click=clear_form, use_container_width=True)
 
     # --- TASK LIST ---
-    st.header("📋 Current Task List")
-    filtered = [
-        t for t in tm.tasks if st.session_state.current_category == "All"
-        or t["category"] == st.session_state.current_category
-    ]
-    if not filtered:
-        st.info("No tasks found.")
-        return
-
-    for i, t in enumerate(filtered):
-        color = CATEGORIES.get(t["category"], "#f0f0f0")
-        with st.container():
-            cols = st.columns([0.4, 2, 1, 1, 2, 1, 1.3])
-            with cols[0]:
-                if st.button("✏️", key=f"edit_{i}"):
-                    st.session_state.edit_mode = True
-                    st.session_state.selected_task = i
-                    st.session_state.form_description = t["description"]
-                    st.session_state.form_building = t["building"]
-                    st.session_state.form_tcd = t["tcd"]
-                    st.session_state.form_comments = t["comments"]
-                    st.session_state.form_category = t["category"]
-                    st.rerun()
-            with cols[1]:
-                st.markdown(f"<b>{t['description']}</b>", unsafe_allow_html=True)
-            with cols[2]:
-                st.write(t["building"])
-            with cols[3]:
-                st.write(t["tcd"] or "-")
-            with cols[4]:
-                st.write(t["comments"] or "-")
-            with cols[5]:
-                st.markdown(f"<span style='background:{color};padding:3px 10px;border-radius:4px;'>{t['category']}</span>", unsafe_allow_html=True)
-            with cols[6]:
-                st.write(t["last_updated"])
-        st.divider()
+    task_list()
 
 # --- RUN APP ---
 if __name__ == "__main__":